@@ -10,9 +10,19 @@ from PIL import Image
 import traceback
 import random
 import re
+import io
+import hashlib
+import multiprocessing
+import threading
+import resource
+import cProfile
+import pstats
+import tracemalloc
 from ftplib import FTP
+from concurrent.futures import ThreadPoolExecutor
 import json
 from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
 
 # add the epd13in3E lib directory to the path
@@ -28,6 +38,8 @@ LOCAL_COVER_BASE_FILE_NAME = "cover"
 CONFIG_FILE_NAME = "config.json"
 BASE_GAMES_DIR = "Media/Games"
 COVERS_DIR_NAME = "Covers"
+THUMBNAIL_CACHE_DIR_NAME = "thumbnails"
+THUMBNAIL_EXTENSION = "png"
 SUPPORTED_IMAGE_EXTENSIONS = {"jpg", "bmp", "png"}
 
 FTP_SERVER_KEY = "ftp_server"
@@ -52,9 +64,33 @@ DISPLAY_TYPE_DEBUG = "debug"
 DISPLAY_TYPE_EPD_5IN_65F = "epd5in65f"
 DISPLAY_TYPE_EPD_13IN_3E = "epd13in3E"
 LOG_LEVEL_KEY = "log_level"
-DEFAULT_CONFIG_VALUES = {FTP_SERVER_KEY:"", FTP_USER_NAME_KEY:"", FTP_USER_PASSWORD_KEY:"", COVER_MATCHERS_KEY:[{BASE_DIR_KEY:"", INCLUDE_REGEXES_KEY:[".*"], EXCLUDE_REGEXES_KEY:[]}], SORT_ORDER_KEY:SORT_ORDER_RANDOM, UPDATE_SECONDS_KEY:3600, ORIENTATION_KEY:ORIENTATION_PORTRAIT, DISPLAY_TYPE_KEY:DISPLAY_TYPE_DEBUG}
+LAYOUT_KEY = "layout"
+LAYOUT_SINGLE = "single"
+LAYOUT_GRID = "grid"
+FRAME_TYPE_THUMBNAIL = "thumbnail"
+GRID_COLUMNS_KEY = "grid_columns"
+GRID_ROWS_KEY = "grid_rows"
+THUMBNAIL_FETCH_WORKERS_KEY = "thumbnail_fetch_workers"
+RENDER_WORKER_KEY = "render_worker"
+RENDER_WORKER_MAX_FRAMES_KEY = "render_worker_max_frames"
+RENDER_WORKER_MAX_RSS_MB_KEY = "render_worker_max_rss_mb"
+RENDER_WORKER_RETRIES_KEY = "render_worker_retries"
+RENDER_WORKER_TIMEOUT_SECONDS = 300
+PROFILE_STATS_FILE_NAME = "profile_cycle.pstats"
+PROFILE_ALLOCATIONS_FILE_NAME = "profile_cycle_allocations.txt"
+PROFILE_STACKS_FILE_NAME = "profile_cycle_stacks.folded"
+PROFILE_STAGE_CRAWL = "crawl"
+PROFILE_STAGE_DOWNLOAD = "download"
+PROFILE_STAGE_RENDER = "render"
+PROFILE_STAGE_DISPLAY = "display"
+PROFILE_TRACEMALLOC_FRAMES = 25
+PROFILE_TOP_ALLOCATIONS = 25
+DEFAULT_CONFIG_VALUES = {FTP_SERVER_KEY:"", FTP_USER_NAME_KEY:"", FTP_USER_PASSWORD_KEY:"", COVER_MATCHERS_KEY:[{BASE_DIR_KEY:"", INCLUDE_REGEXES_KEY:[".*"], EXCLUDE_REGEXES_KEY:[]}], SORT_ORDER_KEY:SORT_ORDER_RANDOM, UPDATE_SECONDS_KEY:3600, ORIENTATION_KEY:ORIENTATION_PORTRAIT, DISPLAY_TYPE_KEY:DISPLAY_TYPE_DEBUG, LAYOUT_KEY:LAYOUT_SINGLE, GRID_COLUMNS_KEY:4, GRID_ROWS_KEY:4, THUMBNAIL_FETCH_WORKERS_KEY:4, RENDER_WORKER_KEY:False, RENDER_WORKER_MAX_FRAMES_KEY:100, RENDER_WORKER_MAX_RSS_MB_KEY:256, RENDER_WORKER_RETRIES_KEY:2}
 
 DISPLAY_LIB = None
+RENDER_WORKER = None
+CYCLE_PROFILER = None
+NEXT_GRID_TILES = []
 
 class DebugEPDConfig:
     def module_exit(self):
@@ -86,11 +122,20 @@ class DebugDisplayLib:
         return DebugDisplay()
 
 
-def getRandomCoverImageViaFTP(config_values, previous_cover_path):
+def getConfigValue(config_values, key):
+    # Keys added after a config file was generated fall back to their defaults
+    return config_values[key] if key in config_values else DEFAULT_CONFIG_VALUES[key]
+
+
+def getFTPLogin(config_values):
     ftp_server = config_values[FTP_SERVER_KEY]
     if (ftp_server == ""):
         raise ValueError(f"ftp_server not set. Update {CONFIG_FILE_NAME}")
-    ftp_user_name, ftp_user_password = config_values[FTP_USER_NAME_KEY], config_values[FTP_USER_PASSWORD_KEY]
+    return (ftp_server, config_values[FTP_USER_NAME_KEY], config_values[FTP_USER_PASSWORD_KEY])
+
+
+def getCoverPathsViaFTP(config_values, cover_facts=None):
+    ftp_server, ftp_user_name, ftp_user_password = getFTPLogin(config_values)
     cover_paths = []
     # Traverse file tree to locate all cover images
     for cover_matcher in config_values[COVER_MATCHERS_KEY]:
@@ -99,13 +144,12 @@ def getRandomCoverImageViaFTP(config_values, previous_cover_path):
         with FTP(ftp_server, ftp_user_name, ftp_user_password) as ftp:
             for mls in ftp.mlsd(base_path):
                 base_mls_list.append(mls)
-            _processPath(cover_matcher, ftp, base_path, base_mls_list, cover_paths)
+            _processPath(cover_matcher, ftp, base_path, base_mls_list, cover_paths, cover_facts)
+    return cover_paths
 
-    if len(cover_paths) == 0:
-        logging.debug("Found no cover paths")
-        return ("", previous_cover_path)
 
-    index = -1
+def selectCoverPaths(config_values, cover_paths, previous_cover_path, count):
+    count = min(count, len(cover_paths))
     sort_order = config_values[SORT_ORDER_KEY]
     found_index = -1
     try:
@@ -115,17 +159,30 @@ def getRandomCoverImageViaFTP(config_values, previous_cover_path):
 
     if sort_order == SORT_ORDER_IN_ORDER:
         index = found_index + 1 if found_index >= 0 else 0
+        indices = [index + offset for offset in range(count)]
     elif sort_order == SORT_ORDER_REVERSE:
         index = found_index - 1 if found_index >= 0 else len(cover_paths) - 1
+        indices = [index - offset for offset in range(count)]
     elif sort_order ==  SORT_ORDER_RANDOM:
-        index = random.randrange(len(cover_paths))
+        indices = random.sample(range(len(cover_paths)), count)
     else:
         raise ValueError(f"sort_order not recognized. Update {CONFIG_FILE_NAME}")
 
-    cover_path = cover_paths[index % len(cover_paths)]
+    return [cover_paths[index % len(cover_paths)] for index in indices]
+
+
+def getRandomCoverImageViaFTP(config_values, previous_cover_path):
+    ftp_server, ftp_user_name, ftp_user_password = getFTPLogin(config_values)
+    with profileStage(PROFILE_STAGE_CRAWL):
+        cover_paths = getCoverPathsViaFTP(config_values)
+    if len(cover_paths) == 0:
+        logging.debug("Found no cover paths")
+        return ("", previous_cover_path)
+
+    cover_path = selectCoverPaths(config_values, cover_paths, previous_cover_path, 1)[0]
     local_cover_file_name = f"{LOCAL_COVER_BASE_FILE_NAME}.{cover_path.split('.')[-1]}"
     local_cover_path = os.path.join(LOCAL_PATH, local_cover_file_name)
-    with FTP(ftp_server, ftp_user_name, ftp_user_password) as ftp:
+    with profileStage(PROFILE_STAGE_DOWNLOAD), FTP(ftp_server, ftp_user_name, ftp_user_password) as ftp:
         try:
             ftp.retrbinary(f"RETR {cover_path}", open(local_cover_path, 'wb').write)
         except Exception as exception:
@@ -134,13 +191,104 @@ def getRandomCoverImageViaFTP(config_values, previous_cover_path):
             cover_path = previous_cover_path
     return (local_cover_path, cover_path)
 
+
+def getCoverTilesViaFTP(config_values, previous_cover_path):
+    global NEXT_GRID_TILES
+    cover_facts = {}
+    with profileStage(PROFILE_STAGE_CRAWL):
+        cover_paths = getCoverPathsViaFTP(config_values, cover_facts)
+    if len(cover_paths) == 0:
+        logging.debug("Found no cover paths")
+        return ([], previous_cover_path)
+
+    columns, rows = getGridDimensions(config_values)
+    cell_size = getGridCellSize(config_values)
+    next_cover_paths = [cover_path for cover_path, _ in NEXT_GRID_TILES]
+    # Use the covers picked at the end of the last cycle when they still exist, so the tiles warmed while sleeping are used
+    if len(next_cover_paths) == min(columns * rows, len(cover_paths)) and set(next_cover_paths).issubset(cover_facts):
+        selected_cover_paths = next_cover_paths
+    else:
+        selected_cover_paths = selectCoverPaths(config_values, cover_paths, previous_cover_path, columns * rows)
+    tiles = [(cover_path, getThumbnailPath(config_values, cover_path, cover_facts[cover_path], cell_size)) for cover_path in selected_cover_paths]
+    with profileStage(PROFILE_STAGE_DOWNLOAD):
+        fetchMissingThumbnails(config_values, tiles, cell_size)
+
+    next_cover_paths = selectCoverPaths(config_values, cover_paths, selected_cover_paths[-1], columns * rows)
+    NEXT_GRID_TILES = [(cover_path, getThumbnailPath(config_values, cover_path, cover_facts[cover_path], cell_size)) for cover_path in next_cover_paths]
+    return ([tile_path for _, tile_path in tiles], selected_cover_paths[-1])
+
+
+def warmNextGridTiles(config_values):
+    if len(NEXT_GRID_TILES) == 0:
+        return
+    logging.debug("Warming thumbnails for the next grid")
+    fetchMissingThumbnails(config_values, NEXT_GRID_TILES, getGridCellSize(config_values))
+
+
+def fetchMissingThumbnails(config_values, tiles, cell_size):
+    # Overlapping cover matchers can select the same cover twice, so fetch each tile only once
+    missing_tiles = list({tile_path: (cover_path, tile_path) for cover_path, tile_path in tiles if not os.path.exists(tile_path)}.values())
+    logging.debug(f"Thumbnail cache hits: {len(tiles) - len(missing_tiles)}, misses: {len(missing_tiles)}")
+    if len(missing_tiles) == 0:
+        return
+    os.makedirs(os.path.dirname(missing_tiles[0][1]), exist_ok=True)
+    worker_count = max(1, min(getConfigValue(config_values, THUMBNAIL_FETCH_WORKERS_KEY), len(missing_tiles)))
+    # Each worker fetches its batch of tiles over a single FTP connection
+    batches = [missing_tiles[worker_index::worker_count] for worker_index in range(worker_count)]
+    _fetchThumbnailBatches(config_values, batches, cell_size)
+
+
+def getThumbnailPath(config_values, cover_path, cover_fact, cell_size):
+    cell_width, cell_height = cell_size
+    # The modify time and size are part of the key so a cover replaced on the server gets a new tile
+    modify, size = cover_fact
+    cover_key = hashlib.sha1(f"{config_values[FTP_SERVER_KEY]}:{cover_path}:{modify}:{size}".encode("utf-8")).hexdigest()
+    return os.path.join(LOCAL_PATH, THUMBNAIL_CACHE_DIR_NAME, f"{cell_width}x{cell_height}", f"{cover_key}.{THUMBNAIL_EXTENSION}")
+
+
+def _fetchThumbnailBatches(config_values, batches, cell_size):
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        futures = [executor.submit(_fetchThumbnailBatch, config_values, batch, cell_size) for batch in batches]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as exception:
+                logging.error(f"Failed to fetch thumbnail batch due to exception [{exception}]")
+
+
+def _fetchThumbnailBatch(config_values, batch, cell_size):
+    ftp_server, ftp_user_name, ftp_user_password = getFTPLogin(config_values)
+    with profileThread(PROFILE_STAGE_DOWNLOAD), FTP(ftp_server, ftp_user_name, ftp_user_password) as ftp:
+        for cover_path, tile_path in batch:
+            try:
+                cover_buffer = io.BytesIO()
+                ftp.retrbinary(f"RETR {cover_path}", cover_buffer.write)
+                if RENDER_WORKER is not None:
+                    RENDER_WORKER.render((FRAME_TYPE_THUMBNAIL, (cover_buffer.getvalue(), tile_path, cell_size)))
+                else:
+                    cover_buffer.seek(0)
+                    _writeThumbnail(cover_buffer, tile_path, cell_size)
+            except Exception as exception:
+                logging.error(f"Failed to create thumbnail for path {cover_path} due to exception [{exception}]")
+
+
+def _writeThumbnail(cover_file, tile_path, cell_size):
+    with Image.open(cover_file) as image:
+        # Let the JPEG decoder downscale while decoding instead of decoding the full scan
+        image.draft("RGB", cell_size)
+        tile = fitToDisplay(image.convert("RGB"), cell_size)
+    # Write to a temporary file first so an interrupted write never leaves a partial tile in the cache
+    temp_tile_path = f"{tile_path}.tmp"
+    tile.save(temp_tile_path, THUMBNAIL_EXTENSION)
+    os.replace(temp_tile_path, tile_path)
+
 def atoi(text):
     return int(text) if text.isdigit() else text
 
 def natural_keys(text):
     return [atoi(c) for c in re.split(r'(\d+)', text)]
 
-def _processPath(cover_matcher, ftp, path, mls_list, cover_paths):
+def _processPath(cover_matcher, ftp, path, mls_list, cover_paths, cover_facts=None):
     mls_list = sorted(mls_list, key=lambda mls: natural_keys(mls[0]))
     include_regexes, exclude_regexes = cover_matcher[INCLUDE_REGEXES_KEY], cover_matcher[EXCLUDE_REGEXES_KEY]
     matched_pattern = None
@@ -169,6 +317,8 @@ def _processPath(cover_matcher, ftp, path, mls_list, cover_paths):
             if is_supported_image and is_included:
                 logging.debug(f"appending cover: {file_path}")
                 cover_paths.append(file_path)
+                if cover_facts is not None:
+                    cover_facts[file_path] = (mls[1].get('modify', ''), mls[1].get('size', ''))
             continue
 
         sub_path = os.path.join(path, mls[0])
@@ -179,7 +329,7 @@ def _processPath(cover_matcher, ftp, path, mls_list, cover_paths):
         except:
             logging.error(f"failed to get mlsd for [{sub_path}]")
             continue
-        _processPath(cover_matcher, ftp, sub_path, sub_mls_list, cover_paths)
+        _processPath(cover_matcher, ftp, sub_path, sub_mls_list, cover_paths, cover_facts)
 
 
 def getRandomLocalCoverPath(previous_cover_path):
@@ -218,7 +368,7 @@ def fitToDisplay(image, display_size):
     return fit_image
 
 
-def rotateImage(image, config_values):
+def getRotateDegrees(config_values):
     rotate_degrees = -1
     orientation = config_values[ORIENTATION_KEY]
     if orientation == ORIENTATION_PORTRAIT:
@@ -231,20 +381,368 @@ def rotateImage(image, config_values):
         rotate_degrees = 270
     else:
         raise ValueError(f"orientation \"{orientation}\" not recognized")
-    return image.rotate(rotate_degrees, expand=True)
+    return rotate_degrees
+
+
+def rotateImage(image, config_values):
+    return image.rotate(getRotateDegrees(config_values), expand=True)
+
+
+def getLayoutSize(config_values):
+    # The size of the display as seen by the viewer, after orientation is applied
+    if getRotateDegrees(config_values) in (90, 270):
+        return (DISPLAY_HEIGHT, DISPLAY_WIDTH)
+    return (DISPLAY_WIDTH, DISPLAY_HEIGHT)
+
+
+def getGridDimensions(config_values):
+    columns, rows = getConfigValue(config_values, GRID_COLUMNS_KEY), getConfigValue(config_values, GRID_ROWS_KEY)
+    if columns < 1 or rows < 1:
+        raise ValueError(f"grid_columns and grid_rows must be at least 1. Update {CONFIG_FILE_NAME}")
+    return (columns, rows)
+
+
+def getGridCellSize(config_values):
+    layout_width, layout_height = getLayoutSize(config_values)
+    columns, rows = getGridDimensions(config_values)
+    return (layout_width // columns, layout_height // rows)
+
+
+def composeGrid(tile_paths, config_values):
+    layout_width, layout_height = getLayoutSize(config_values)
+    columns, rows = getGridDimensions(config_values)
+    cell_width, cell_height = getGridCellSize(config_values)
+    # Center the grid when the layout does not divide evenly into cells
+    left_padding = int((layout_width - cell_width * columns) / 2)
+    top_padding = int((layout_height - cell_height * rows) / 2)
+    collage = Image.new("RGB", (layout_width, layout_height), (0, 0, 0))
+    for index, tile_path in enumerate(tile_paths):
+        column, row = index % columns, index // columns
+        try:
+            with Image.open(tile_path) as tile:
+                collage.paste(tile, (left_padding + column * cell_width, top_padding + row * cell_height))
+        except Exception as exception:
+            # Remove unreadable tiles, e.g. truncated by a power cut, so the next cycle fetches them again
+            logging.error(f"composeGrid: failed to read thumbnail {tile_path} due to exception [{exception}]")
+            if (os.path.exists(tile_path)):
+                os.remove(tile_path)
+    return collage
+
+
+def renderImage(display, image, config_values):
+    image = rotateImage(image, config_values)
+    image = fitToDisplay(image, (DISPLAY_WIDTH, DISPLAY_HEIGHT))
+    return display.getbuffer(image)
+
+
+def renderFrame(frame, config_values):
+    # A frame is (layout, paths) and is rendered into a packed buffer ready for the display.
+    # A thumbnail frame carries the downloaded cover instead and writes its tile to the cache
+    layout, paths = frame
+    if layout == FRAME_TYPE_THUMBNAIL:
+        cover_bytes, tile_path, cell_size = paths
+        _writeThumbnail(io.BytesIO(cover_bytes), tile_path, cell_size)
+        return None
+    display = DISPLAY_LIB.EPD()
+    if layout == LAYOUT_SINGLE:
+        with Image.open(paths) as image:
+            return renderImage(display, image, config_values)
+    elif layout == LAYOUT_GRID:
+        return renderImage(display, composeGrid(paths, config_values), config_values)
+    raise ValueError(f"layout \"{layout}\" not recognized. Update {CONFIG_FILE_NAME}")
+
+
+def displayFrame(frame, config_values):
+    try:
+        with profileStage(PROFILE_STAGE_RENDER):
+            if RENDER_WORKER is not None:
+                buffer = RENDER_WORKER.render(frame)
+            else:
+                buffer = renderFrame(frame, config_values)
+    except RuntimeError as exception:
+        logging.error(f"displayFrame: failed to render frame due to exception [{exception}]")
+        return
+    with profileStage(PROFILE_STAGE_DISPLAY):
+        display = DISPLAY_LIB.EPD()
+        display.init()
+        display.display(buffer)
+        display.sleep()
 
 
 def displayImage(image_path, config_values):
     if (not os.path.exists(image_path)):
         logging.error(f"displayImage: no file exists for path {image_path}")
         return
-    display = DISPLAY_LIB.EPD()
-    display.init()
-    with Image.open(image_path) as image:
-        image = rotateImage(image, config_values)
-        image = fitToDisplay(image, (DISPLAY_WIDTH, DISPLAY_HEIGHT))
-        display.display(display.getbuffer(image))
-    display.sleep()
+    displayFrame((LAYOUT_SINGLE, image_path), config_values)
+
+
+def displayGrid(tile_paths, config_values):
+    # Like the single layout, keep showing the previous frame rather than refreshing to missing covers
+    tile_paths = [tile_path for tile_path in tile_paths if os.path.exists(tile_path)]
+    if len(tile_paths) == 0:
+        logging.error("displayGrid: no thumbnails to display")
+        return
+    displayFrame((LAYOUT_GRID, tile_paths), config_values)
+
+
+def _renderWorkerMain(connection, config_values):
+    if (not initLogging(config_values)) or (not initDisplay(config_values)):
+        return
+    try:
+        while (True):
+            frame = connection.recv()
+            if frame is None:
+                break
+            try:
+                buffer = renderFrame(frame, config_values)
+                result = (True, None if buffer is None else bytes(buffer))
+            except Exception as exception:
+                result = (False, f"{exception}")
+            # ru_maxrss is reported in kilobytes on Linux
+            connection.send(result + (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        connection.close()
+
+
+class RenderWorker:
+    # Decodes and renders frames in a separate process so heap fragmentation from decoding
+    # images of very different sizes is discarded whenever the process is recycled
+
+    def __init__(self, config_values):
+        self.config_values = config_values
+        self.max_frames = getConfigValue(config_values, RENDER_WORKER_MAX_FRAMES_KEY)
+        self.max_rss_kb = getConfigValue(config_values, RENDER_WORKER_MAX_RSS_MB_KEY) * 1024
+        self.retries = getConfigValue(config_values, RENDER_WORKER_RETRIES_KEY)
+        self.process = None
+        self.connection = None
+        self.frame_count = 0
+        # Thumbnail fetch threads share the worker, so only one frame is in flight at a time
+        self.lock = threading.Lock()
+
+    def start(self):
+        # spawn rather than fork so the worker starts from a fresh heap
+        context = multiprocessing.get_context("spawn")
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_renderWorkerMain, args=(worker_connection, self.config_values), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        self.frame_count = 0
+        logging.debug(f"RenderWorker.start(): started worker process {self.process.pid}")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+        logging.debug(f"RenderWorker.stop(): stopped worker process {self.process.pid}")
+        self.process = None
+        self.connection = None
+
+    def render(self, frame):
+        with self.lock:
+            return self._render(frame)
+
+    def _render(self, frame):
+        for attempt in range(self.retries + 1):
+            if self.process is None:
+                self.start()
+            try:
+                self.connection.send(frame)
+                if not self.connection.poll(RENDER_WORKER_TIMEOUT_SECONDS):
+                    raise TimeoutError(f"no response after {RENDER_WORKER_TIMEOUT_SECONDS} seconds")
+                success, result, max_rss_kb = self.connection.recv()
+            except (EOFError, OSError) as exception:
+                logging.error(f"Render worker failed on attempt {attempt + 1} with exit code {self.process.exitcode} due to exception [{exception}]")
+                self.stop()
+                continue
+
+            # Only displayed frames count towards recycling, the RSS ceiling still covers thumbnails
+            if frame[0] != FRAME_TYPE_THUMBNAIL:
+                self.frame_count += 1
+            if self.frame_count >= self.max_frames or max_rss_kb >= self.max_rss_kb:
+                logging.info(f"Recycling render worker after {self.frame_count} frames with max RSS of {max_rss_kb} KB")
+                self.stop()
+            if not success:
+                raise RuntimeError(result)
+            return result
+        raise RuntimeError(f"render worker crashed {self.retries + 1} times")
+
+
+def initRenderWorker(config_values):
+    global RENDER_WORKER
+    if getConfigValue(config_values, RENDER_WORKER_KEY):
+        logging.info("initRenderWorker: rendering in a worker process")
+        RENDER_WORKER = RenderWorker(config_values)
+
+
+def _profileFunctionLabel(function):
+    file_name, line_number, function_name = function
+    if file_name == "~":
+        return function_name
+    return f"{function_name} ({os.path.basename(file_name)}:{line_number})"
+
+
+def _foldStacks(stats, stage_name, folded_stacks):
+    # Rebuild call stacks from the caller graph, attributing a callee's time to each caller by its share of calls
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((function, caller_stats[3]))
+
+    def foldFunction(function, stack, scale):
+        _, _, self_time, total_time, _ = stats.stats[function]
+        stack = stack + [function]
+        stack_key = ";".join([stage_name] + [_profileFunctionLabel(stack_function) for stack_function in stack])
+        folded_stacks[stack_key] = folded_stacks.get(stack_key, 0) + self_time * scale
+        for callee, edge_time in callees.get(function, []):
+            callee_total_time = stats.stats[callee][3]
+            # Skip recursive calls and branches too small to show up in a flame graph
+            if callee in stack or callee_total_time <= 0 or edge_time * scale < 1e-6:
+                continue
+            foldFunction(callee, stack, scale * edge_time / callee_total_time)
+
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if len(callers) == 0:
+            foldFunction(function, [], 1.0)
+
+
+class CycleProfiler:
+    # Profiles each stage of a display cycle separately so the results can be broken down by stage
+
+    def __init__(self):
+        self.profiles = {}
+        self.thread_profiles = {}
+        self.thread_profiles_lock = threading.Lock()
+        self.stage_results = []
+        self.active_stage = None
+        self.previous_snapshot = None
+
+    def start(self):
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        self.previous_snapshot = self._takeSnapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def _takeSnapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")))
+
+    @contextmanager
+    def stage(self, stage_name):
+        # Nested stages are attributed to the outermost stage
+        if self.active_stage is not None:
+            yield
+            return
+        profile = self.profiles.setdefault(stage_name, cProfile.Profile())
+        self.active_stage = stage_name
+        tracemalloc.reset_peak()
+        # ru_maxrss is the high water mark of the whole process in kilobytes on Linux
+        start_max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active_stage = None
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            end_max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Snapshot before the caller of the stage releases what the stage produced
+            snapshot = self._takeSnapshot()
+            allocation_diffs = snapshot.compare_to(self.previous_snapshot, "lineno")[:PROFILE_TOP_ALLOCATIONS]
+            self.previous_snapshot = snapshot
+            self.stage_results.append((stage_name, traced_peak, start_max_rss_kb, end_max_rss_kb, allocation_diffs))
+
+    @contextmanager
+    def thread(self, stage_name):
+        # Profiles work a stage hands off to another thread so it is merged into that stage
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 only one profiler can be active and the stage profile already sees every thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.thread_profiles_lock:
+                self.thread_profiles.setdefault(stage_name, []).append(profile)
+
+    def _stageProfiles(self, stage_name):
+        return [self.profiles[stage_name]] + self.thread_profiles.get(stage_name, [])
+
+    def write(self):
+        if len(self.profiles) == 0:
+            logging.error("CycleProfiler.write(): no stages were profiled")
+            return
+        stats_path = os.path.join(LOCAL_PATH, PROFILE_STATS_FILE_NAME)
+        pstats.Stats(*[profile for stage_name in self.profiles for profile in self._stageProfiles(stage_name)]).dump_stats(stats_path)
+        logging.info(f"Wrote profile stats to {stats_path}")
+
+        allocations_path = os.path.join(LOCAL_PATH, PROFILE_ALLOCATIONS_FILE_NAME)
+        with open(allocations_path, 'w', encoding="utf-8") as allocations_file:
+            allocations_file.write("tracemalloc only traces allocations on the Python heap. Image pixel buffers are allocated by Pillow in C\n")
+            allocations_file.write("and only show up in the RSS high water mark, which covers the whole process.\n")
+            for stage_name, traced_peak, start_max_rss_kb, end_max_rss_kb, allocation_diffs in self.stage_results:
+                allocations_file.write(f"\n[{stage_name}]\n")
+                allocations_file.write(f"Peak traced Python memory: {traced_peak / 1024:.1f} KiB\n")
+                allocations_file.write(f"RSS high water mark: {end_max_rss_kb} KiB (+{end_max_rss_kb - start_max_rss_kb} KiB during stage)\n")
+                allocations_file.write(f"Top {PROFILE_TOP_ALLOCATIONS} allocation sites compared to the end of the previous stage:\n")
+                for statistic in allocation_diffs:
+                    allocations_file.write(f"{statistic}\n")
+        logging.info(f"Wrote allocation sites to {allocations_path}")
+
+        stacks_path = os.path.join(LOCAL_PATH, PROFILE_STACKS_FILE_NAME)
+        folded_stacks = {}
+        for stage_name in self.profiles:
+            _foldStacks(pstats.Stats(*self._stageProfiles(stage_name)), stage_name, folded_stacks)
+        with open(stacks_path, 'w', encoding="utf-8") as stacks_file:
+            for stack_key, stack_time in folded_stacks.items():
+                # Folded stack counts are whole numbers, so record time in microseconds
+                stack_microseconds = int(stack_time * 1000000)
+                if stack_microseconds > 0:
+                    stacks_file.write(f"{stack_key} {stack_microseconds}\n")
+        logging.info(f"Wrote folded stacks to {stacks_path}")
+
+
+@contextmanager
+def profileStage(stage_name):
+    if CYCLE_PROFILER is None:
+        yield
+    else:
+        with CYCLE_PROFILER.stage(stage_name):
+            yield
+
+
+@contextmanager
+def profileThread(stage_name):
+    if CYCLE_PROFILER is None:
+        yield
+    else:
+        with CYCLE_PROFILER.thread(stage_name):
+            yield
+
+
+def profileCycle(config_values):
+    global CYCLE_PROFILER
+    CYCLE_PROFILER = CycleProfiler()
+    CYCLE_PROFILER.start()
+    try:
+        runCycle(config_values, "")
+    finally:
+        CYCLE_PROFILER.stop()
+        CYCLE_PROFILER.write()
+        CYCLE_PROFILER = None
 
 def createConfig():
     with open(os.path.join(LOCAL_PATH, CONFIG_FILE_NAME), 'w', encoding="utf-8") as config_file:
@@ -285,7 +783,31 @@ def initDisplay(config_values):
         return False
     return True
 
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Displays cover art from a collection on an e-paper display")
+    parser.add_argument("--profile-cycle", action="store_true", help=f"run a single display cycle under cProfile and tracemalloc, write the results next to {CONFIG_FILE_NAME} and exit")
+    return parser.parse_args()
+
+def runCycle(config_values, previous_cover_path):
+    for extension in SUPPORTED_IMAGE_EXTENSIONS:
+        old_cover_path = os.path.join(LOCAL_PATH, f"{LOCAL_COVER_BASE_FILE_NAME}.{extension}")
+        if (os.path.exists(old_cover_path)):
+            os.remove(old_cover_path)
+    layout = getConfigValue(config_values, LAYOUT_KEY)
+    if layout == LAYOUT_SINGLE:
+        local_cover_path, cover_path = getRandomCoverImageViaFTP(config_values, previous_cover_path)
+        logging.debug(f"Displaying: {cover_path}")
+        displayImage(local_cover_path, config_values)
+    elif layout == LAYOUT_GRID:
+        tile_paths, cover_path = getCoverTilesViaFTP(config_values, previous_cover_path)
+        logging.debug(f"Displaying grid of {len(tile_paths)} covers ending with: {cover_path}")
+        displayGrid(tile_paths, config_values)
+    else:
+        raise ValueError(f"layout \"{layout}\" not recognized. Update {CONFIG_FILE_NAME}")
+    return cover_path
+
 def main():
+    arguments = parseArguments()
     if (not os.path.exists(os.path.join(LOCAL_PATH, CONFIG_FILE_NAME))):
         createConfig()
         print("Config file created. Fill it out and run again")
@@ -296,22 +818,28 @@ def main():
     if (not initLogging(config_values)) or (not initDisplay(config_values)):
         return
 
+    if (arguments.profile_cycle):
+        # Render in process so the render stage is profiled rather than the wait on the worker
+        logging.info("Profiling a single display cycle")
+        profileCycle(config_values)
+        return
+
+    initRenderWorker(config_values)
+
     try:
         previous_cover_path = ""
         while (True):
-            for extension in SUPPORTED_IMAGE_EXTENSIONS:
-                old_cover_path = os.path.join(LOCAL_PATH, f"{LOCAL_COVER_BASE_FILE_NAME}.{extension}")
-                if (os.path.exists(old_cover_path)):
-                    os.remove(old_cover_path)
-            local_cover_path, cover_path = getRandomCoverImageViaFTP(config_values, previous_cover_path)
-            logging.debug(f"Displaying: {cover_path}")
-            displayImage(local_cover_path, config_values)
-            previous_cover_path = cover_path
+            previous_cover_path = runCycle(config_values, previous_cover_path)
             update_seconds = config_values[UPDATE_SECONDS_KEY]
-            logging.debug(f"Sleeping for {update_seconds} seconds")
-            time.sleep(update_seconds)
+            sleep_start = time.monotonic()
+            warmNextGridTiles(config_values)
+            sleep_seconds = max(0, update_seconds - (time.monotonic() - sleep_start))
+            logging.debug(f"Sleeping for {sleep_seconds} seconds")
+            time.sleep(sleep_seconds)
     except KeyboardInterrupt:
         logging.info("Exiting for keyboard interrupt")
+        if RENDER_WORKER is not None:
+            RENDER_WORKER.stop()
         display = DISPLAY_LIB.EPD()
         display.init()
         display.Clear()